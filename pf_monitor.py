@@ -15,14 +15,19 @@ Required environment variables:
 
 import os
 import re
+import codecs
+import json
+import time
+import argparse
 import smtplib
 import logging
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from contextlib import contextmanager
+from functools import lru_cache
+from email.message import EmailMessage
 from datetime import datetime, date, timedelta
 
-import requests
-from bs4 import BeautifulSoup
+import httpx
+from lxml import etree
 
 # ─── CONFIGURATION (from environment variables) ──────────────────────────────
 ORGANISER_URL = os.environ["ORGANISER_URL"]
@@ -35,8 +40,28 @@ SIGNUP_BASE_URL = os.environ["SIGNUP_BASE_URL"]
 SIGNUP_THRESHOLD = 12
 SIGNUP_REFERENCE_DATE = date(2026, 2, 21)
 SIGNUP_REFERENCE_NUMBER = 59
+_SIGNUP_REFERENCE_ORDINAL = SIGNUP_REFERENCE_DATE.toordinal()
+
+# Saturday 14:30 — after this the target moves on to the following week
+SATURDAY_CUTOFF_MINUTES = 14 * 60 + 30
+
+ALERTED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alerted.json")
+# Pre-JSON format, one date per line; only read until the first mark_alerted writes ALERTED_FILE
+LEGACY_ALERTED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alerted.txt")
+ALERT_RETENTION_DAYS = 90
+PAGE_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "page_cache.json")
+
+# ─── SESSION TITLE PATTERNS ───────────────────────────────────────────────────
+# One pass over the title: "Sat[urday] <day> <month> ... BOOKINGS: <cur>/<max>".
+# Only the day/month part is case-insensitive; BOOKINGS must be upper case.
+_SESSION_RE = re.compile(
+    r'\bSat(?:urday)?\s+(?P<day>\d{1,2})\s+(?P<mon>Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)'
+    r'.*?(?-i:BOOKINGS):\s*(?P<cur>\d+)\s*/\s*(?P<max>\d+)',
+    re.IGNORECASE | re.DOTALL,
+)
 
-ALERTED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alerted.txt")
+# Month number is find(abbrev) // 3 + 1; no abbreviation occurs off its 3-char slot
+_MONTH_STR = "janfebmaraprmayjunjulaugsepoctnovdec"
 
 # ─── LOGGING ──────────────────────────────────────────────────────────────────
 logging.basicConfig(
@@ -50,120 +75,244 @@ log = logging.getLogger("playfit_monitor")
 # ─── ALERT TRACKING ──────────────────────────────────────────────────────────
 
 def get_alerted_dates():
-    if not os.path.exists(ALERTED_FILE):
+    try:
+        with open(ALERTED_FILE, "r") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        log.warning(f"  Could not read {ALERTED_FILE} — treating as empty.")
+        return set()
+    else:
+        # Valid JSON can still be the wrong shape (5, null, [1, 2]); treat that as corrupt too
+        if isinstance(data, list) and all(isinstance(d, str) for d in data):
+            return set(data)
+        log.warning(f"  Unexpected contents in {ALERTED_FILE} — treating as empty.")
+        return set()
+
+    try:
+        with open(LEGACY_ALERTED_FILE, "r") as f:
+            return set(line.strip() for line in f if line.strip())
+    except FileNotFoundError:
         return set()
-    with open(ALERTED_FILE, "r") as f:
-        return set(line.strip() for line in f if line.strip())
 
 
-def mark_alerted(date_str):
-    with open(ALERTED_FILE, "a") as f:
-        f.write(date_str + "\n")
+def mark_alerted(date_str, today):
+    # ISO dates sort lexically, so old entries can be pruned with a plain string compare
+    cutoff = (today - timedelta(days=ALERT_RETENTION_DAYS)).isoformat()
+    alerted = {d for d in get_alerted_dates() if d >= cutoff}
+    alerted.add(date_str)
+
+    tmp_file = ALERTED_FILE + ".tmp"
+    payload = json.dumps(sorted(alerted)).encode()
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # os.write may write less than asked (e.g. a nearly full disk), and a truncated
+        # file must never replace the real one
+        written = 0
+        while written < len(payload):
+            written += os.write(fd, payload[written:])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_file, ALERTED_FILE)
     log.info(f"  Marked {date_str} as alerted")
 
 
 # ─── TARGET SATURDAY ──────────────────────────────────────────────────────────
 
-def get_target_saturday():
-    now = datetime.now()
+def get_target_saturday(now):
     today = now.date()
     weekday = today.weekday()
 
-    if weekday == 5:
-        if now.hour < 14 or (now.hour == 14 and now.minute < 30):
-            return today
-        else:
-            return today + timedelta(days=7)
-    else:
-        days_ahead = 5 - weekday
-        if days_ahead <= 0:
-            days_ahead += 7
-        return today + timedelta(days=days_ahead)
+    # Days until the coming Saturday, rolling over to next week once today's session has started
+    past_cutoff = weekday == 5 and now.hour * 60 + now.minute >= SATURDAY_CUTOFF_MINUTES
+    return today + timedelta(days=(5 - weekday) % 7 + 7 * past_cutoff)
 
 
-def parse_session_date(text):
-    match = re.search(r'Sat\s+(\d{1,2})\s+(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)', text, re.IGNORECASE)
-    if not match:
-        return None
+@lru_cache(maxsize=64)
+def get_signup_link(target_date):
+    weeks_diff = (target_date.toordinal() - _SIGNUP_REFERENCE_ORDINAL) // 7
+    session_number = SIGNUP_REFERENCE_NUMBER + weeks_diff
+    return f"{SIGNUP_BASE_URL}{session_number}/"
+
+
+# ─── PAGE FETCHING ────────────────────────────────────────────────────────────
+
+# WordPress's password prompt: a <form> tag whose class list includes post-password-form
+_PASSWORD_FORM_RE = re.compile(
+    rb'<form\b[^>]*\bclass\s*=\s*["\']?[^"\'>]*\bpost-password-form\b',
+    re.IGNORECASE,
+)
+
+_http_client = None
+
+
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        # One HTTP/2 connection carries both the postpass POST and the page GET
+        # httpx defaults to a 5s timeout; the WordPress host can be slower than that to render the page
+        _http_client = httpx.Client(
+            http2=True,
+            timeout=httpx.Timeout(60.0, connect=15.0),
+            headers={
+                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+                "Accept-Encoding": "gzip, br",
+            },
+        )
+    return _http_client
 
-    day = int(match.group(1))
-    month_str = match.group(2)
-    month_map = {
-        "jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6,
-        "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12,
-    }
-    month = month_map[month_str.lower()]
-    year = datetime.now().year
 
+def load_page_validators(cache_key):
     try:
-        return date(year, month, day)
-    except ValueError:
-        return None
+        with open(PAGE_CACHE_FILE, "r") as f:
+            cached = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    # Validators from a previous target Saturday must not suppress the first check for a new one
+    if cached.get("key") != cache_key:
+        return {}
+    return cached
 
 
-def get_signup_link(target_date):
-    weeks_diff = (target_date - SIGNUP_REFERENCE_DATE).days // 7
-    session_number = SIGNUP_REFERENCE_NUMBER + weeks_diff
-    return f"{SIGNUP_BASE_URL}{session_number}/"
+def save_page_validators(cache_key, validators):
+    with open(PAGE_CACHE_FILE, "w") as f:
+        json.dump({"key": cache_key, **validators}, f)
 
 
-# ─── PAGE FETCHING ────────────────────────────────────────────────────────────
+def clear_page_validators():
+    try:
+        os.remove(PAGE_CACHE_FILE)
+    except FileNotFoundError:
+        pass
+
 
-def get_authenticated_page():
-    session = requests.Session()
+def get_authenticated_page(cache_key):
+    client = get_http_client()
 
     postpass_url = ORGANISER_URL.rsplit("/w/", 1)[0] + "/w/wp-login.php?action=postpass"
 
-    session.post(
+    # Only the wp-postpass cookie on the 302 is needed; its redirect target is the page fetched below
+    client.post(
         postpass_url,
         data={"post_password": PAGE_PASSWORD, "Submit": "Enter"},
-        headers={
-            "Referer": ORGANISER_URL,
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-        },
-        allow_redirects=True,
+        headers={"Referer": ORGANISER_URL},
+        follow_redirects=False,
     )
 
-    page_resp = session.get(
-        ORGANISER_URL,
-        headers={
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-        },
-    )
+    headers = {}
+    cached = load_page_validators(cache_key)
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
 
-    soup = BeautifulSoup(page_resp.text, "html.parser")
-    if soup.find("form", class_="post-password-form"):
+    page_resp = client.get(ORGANISER_URL, headers=headers)
+
+    # No body tells the caller nothing has changed since the last successful check
+    if page_resp.status_code == 304:
+        return None, None, None
+
+    if _PASSWORD_FORM_RE.search(page_resp.content):
         raise Exception("Authentication failed — password may be incorrect.")
 
-    return page_resp.text
+    # Only saved by the caller once this page has been fully checked
+    validators = {}
+    if page_resp.status_code == 200:
+        validators = {
+            "etag": page_resp.headers.get("ETag"),
+            "last_modified": page_resp.headers.get("Last-Modified"),
+        }
+
+    # The raw bytes go straight to lxml; the header charset goes with them so it isn't left to guess
+    return page_resp.content, page_resp.encoding, validators
 
 
 # ─── PARSING ──────────────────────────────────────────────────────────────────
 
-def parse_saturday_sessions(html):
-    soup = BeautifulSoup(html, "html.parser")
-    sessions = []
+class SpoilerTitleCollector:
+    # lxml parser target: gathers the text of each div.su-spoiler-title without building a tree.
+    # Each text node is stripped and the pieces are joined with no separator.
+
+    def __init__(self):
+        self.titles = []
+        self._depth = 0
+        self._parts = []
+        self._chunk = []
+
+    def _flush_chunk(self):
+        text = "".join(self._chunk).strip()
+        if text:
+            self._parts.append(text)
+        self._chunk = []
+
+    def start(self, tag, attrib):
+        if self._depth:
+            self._flush_chunk()
+            self._depth += 1
+        elif tag == "div" and "su-spoiler-title" in attrib.get("class", "").split():
+            self._depth = 1
+
+    def end(self, tag):
+        if not self._depth:
+            return
+        self._flush_chunk()
+        self._depth -= 1
+        if not self._depth:
+            self.titles.append("".join(self._parts))
+            self._parts = []
+
+    def data(self, data):
+        if self._depth:
+            self._chunk.append(data)
+
+    def close(self):
+        return self.titles
+
+
+def _lxml_encoding(encoding):
+    # httpx accepts any Python codec alias ("latin-1", "u8"); libxml2 only knows canonical names
+    if not encoding:
+        return None
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return None
+    # libxml2 has no utf-8-sig but skips a UTF-8 BOM itself
+    return "utf-8" if name == "utf-8-sig" else name
 
-    spoiler_titles = soup.find_all("div", class_="su-spoiler-title")
 
-    for title_div in spoiler_titles:
-        text = title_div.get_text(strip=True)
+def parse_saturday_sessions(html, encoding, year):
+    # No bookings block anywhere (e.g. off-season) means nothing can match, so skip parsing.
+    # Test for the bare word: markup or an entity can sit between BOOKINGS and its colon.
+    if b"BOOKINGS" not in html:
+        return []
 
-        if not re.search(r'\bSat(?:urday)?\b', text, re.IGNORECASE):
-            continue
+    collector = SpoilerTitleCollector()
+    try:
+        parser = etree.HTMLParser(target=collector, encoding=_lxml_encoding(encoding))
+    except LookupError:
+        # A codec libxml2 doesn't know; let it detect the charset from the document instead
+        parser = etree.HTMLParser(target=collector)
+    parser.feed(html)
+    sessions = []
 
-        booking_match = re.search(r'BOOKINGS:\s*(\d+)\s*/\s*(\d+)', text)
-        if not booking_match:
+    for text in parser.close():
+        match = _SESSION_RE.search(text)
+        if not match:
             continue
 
-        current = int(booking_match.group(1))
-        total = int(booking_match.group(2))
-        session_date = parse_session_date(text)
+        try:
+            session_date = date(year, _MONTH_STR.find(match["mon"].lower()) // 3 + 1, int(match["day"]))
+        except ValueError:
+            # Impossible date such as "Sat 31 Feb" — it can never be the target Saturday
+            continue
 
         sessions.append({
             "description": text.strip(),
-            "current_signups": current,
-            "max_signups": total,
+            "current_signups": int(match["cur"]),
+            "max_signups": int(match["max"]),
             "date": session_date,
         })
 
@@ -172,7 +321,45 @@ def parse_saturday_sessions(html):
 
 # ─── EMAIL ────────────────────────────────────────────────────────────────────
 
-def send_email_alert(session_info, signup_link):
+_smtp = None
+
+
+def _smtp_is_alive(server):
+    try:
+        return server.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+def close_smtp():
+    global _smtp
+    if _smtp is None:
+        return
+    try:
+        _smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        pass
+    _smtp.close()
+    _smtp = None
+
+
+@contextmanager
+def smtp_connection():
+    # Reuse the logged-in connection from an earlier check while the server keeps it open
+    global _smtp
+    if _smtp is None or not _smtp_is_alive(_smtp):
+        close_smtp()
+        server = smtplib.SMTP_SSL("smtp.gmail.com", 465)
+        try:
+            server.login(GMAIL_ADDRESS, GMAIL_APP_PASSWORD)
+        except Exception:
+            server.close()
+            raise
+        _smtp = server
+    yield _smtp
+
+
+def send_email_alert(session_info, signup_link, smtp, now):
     subject = f"🏀 PlayFit Alert: {session_info['current_signups']}/{session_info['max_signups']} signups!"
 
     body = f"""Hi,
@@ -186,19 +373,17 @@ Signups: {session_info['current_signups']} / {session_info['max_signups']}
 Sign up here: {signup_link}
 
 — PlayFit Monitor
-(Checked at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+(Checked at {now.strftime('%Y-%m-%d %H:%M:%S')})
 """
 
-    msg = MIMEMultipart()
+    msg = EmailMessage()
     msg["From"] = GMAIL_ADDRESS
     msg["To"] = ", ".join(NOTIFY_EMAILS)
     msg["Subject"] = subject
-    msg.attach(MIMEText(body, "plain"))
+    msg.set_content(body)
 
     try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(GMAIL_ADDRESS, GMAIL_APP_PASSWORD)
-            server.sendmail(GMAIL_ADDRESS, NOTIFY_EMAILS, msg.as_string())
+        smtp.send_message(msg)
         log.info(f"✅ Alert email sent for: {session_info['description'][:80]}...")
         return True
     except Exception as e:
@@ -208,31 +393,25 @@ Sign up here: {signup_link}
 
 # ─── MAIN CHECK ───────────────────────────────────────────────────────────────
 
-def check_and_alert():
-    target_sat = get_target_saturday()
-    log.info(f"Checking PlayFit organiser page... (looking for Sat {target_sat.strftime('%d %b %Y')})")
-
-    try:
-        html = get_authenticated_page()
-    except Exception as e:
-        log.error(f"Failed to fetch page: {e}")
-        return
-
-    sessions = parse_saturday_sessions(html)
+def check_target_session(html, encoding, target_sat, now):
+    # Returns False when the check must be repeated even if the page is unchanged
+    sessions = parse_saturday_sessions(html, encoding, now.year)
 
     if not sessions:
         log.warning("No Saturday sessions found on the page.")
-        return
+        return True
 
     target_session = None
     for s in sessions:
-        log.info(f"  Found: {s['description'][:100]}... (date: {s['date']})")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"  Found: {s['description'][:100]}... (date: {s['date']})")
         if s["date"] == target_sat:
             target_session = s
+            break
 
     if not target_session:
         log.warning(f"  No session found matching target date {target_sat.strftime('%d %b %Y')}.")
-        return
+        return True
 
     current = target_session["current_signups"]
     maximum = target_session["max_signups"]
@@ -243,17 +422,80 @@ def check_and_alert():
     alerted_dates = get_alerted_dates()
     if date_str in alerted_dates:
         log.info(f"  ✓ Already alerted for {date_str} — skipping.")
+        return True
+
+    if current < SIGNUP_THRESHOLD:
+        log.info(f"  ✓ Below threshold ({current} < {SIGNUP_THRESHOLD})")
+        return True
+
+    signup_link = get_signup_link(target_sat)
+    log.info(f"  🚨 Threshold reached! Sending alert...")
+    log.info(f"  🔗 Signup link: {signup_link}")
+    sent = False
+    try:
+        with smtp_connection() as smtp:
+            sent = send_email_alert(target_session, signup_link, smtp, now)
+    except Exception as e:
+        log.error(f"❌ Mail server error: {e}")
+
+    if sent:
+        mark_alerted(date_str, now.date())
+    return sent
+
+
+def check_and_alert():
+    now = datetime.now()
+    target_sat = get_target_saturday(now)
+    cache_key = target_sat.isoformat()
+    log.info(f"Checking PlayFit organiser page... (looking for Sat {target_sat.strftime('%d %b %Y')})")
+
+    try:
+        html, encoding, validators = get_authenticated_page(cache_key)
+    except Exception as e:
+        log.error(f"Failed to fetch page: {e}")
         return
 
-    if current >= SIGNUP_THRESHOLD:
-        signup_link = get_signup_link(target_sat)
-        log.info(f"  🚨 Threshold reached! Sending alert...")
-        log.info(f"  🔗 Signup link: {signup_link}")
-        if send_email_alert(target_session, signup_link):
-            mark_alerted(date_str)
+    if html is None:
+        log.info("  ✓ Page unchanged since last check — skipping.")
+        return
+
+    # Validators are only kept once the page has been fully handled, so a failed alert or a
+    # crash part-way through means the next run fetches and checks the page again
+    if check_target_session(html, encoding, target_sat, now):
+        save_page_validators(cache_key, validators)
     else:
-        log.info(f"  ✓ Below threshold ({current} < {SIGNUP_THRESHOLD})")
+        clear_page_validators()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monitor PlayFit Saturday session signups.")
+    parser.add_argument(
+        "--loop",
+        type=int,
+        metavar="SECONDS",
+        help="keep running and check again every SECONDS seconds instead of checking once",
+    )
+    args = parser.parse_args()
+    if args.loop is not None and args.loop <= 0:
+        parser.error("--loop must be a positive number of seconds")
+
+    try:
+        if args.loop is None:
+            check_and_alert()
+            return
+
+        log.info(f"Running in loop mode, checking every {args.loop}s")
+        while True:
+            try:
+                check_and_alert()
+            except Exception as e:
+                log.error(f"Check failed: {e}")
+            time.sleep(args.loop)
+    except KeyboardInterrupt:
+        log.info("Stopped.")
+    finally:
+        close_smtp()
 
 
 if __name__ == "__main__":
-    check_and_alert()
+    main()